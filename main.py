@@ -1,18 +1,56 @@
+import atexit
+import hashlib
+import logging
 import os
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from uuid import uuid4
 from dotenv import load_dotenv
-from fastapi import FastAPI, Depends, Request, Form, HTTPException
+from fastapi import FastAPI, Depends, Request, Form, Query, HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.exceptions import RequestValidationError
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import RedirectResponse
+from fastapi.responses import ORJSONResponse, RedirectResponse, Response
 from fastapi.middleware.httpsredirect import HTTPSRedirectMiddleware
-from sqlalchemy import create_engine, Column, Integer, String
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session
+from sqlalchemy import String, delete, insert, select, text
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.pool import NullPool
 
 # Load environment variables from .env file (will be ignored if file doesn't exist)
 load_dotenv()
 
+# Development mode (template auto-reload etc.)
+DEBUG = os.getenv("DEBUG") == "1"
+
+# Log records are queued and written to stdout by a background thread
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+log_listener.start()
+atexit.register(log_listener.stop)
+logging.basicConfig(level=logging.INFO, handlers=[QueueHandler(log_queue)])
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG if DEBUG else logging.INFO)
+
+class RecordQueueHandler(QueueHandler):
+    # Queue records as-is: uvicorn's access formatter needs the original args
+    def prepare(self, record):
+        return record
+
+# uvicorn sets up its own (non-propagating) handlers before importing the app,
+# so move those onto background listeners too, access log included
+for name in ("uvicorn", "uvicorn.access"):
+    uvicorn_logger = logging.getLogger(name)
+    if uvicorn_logger.handlers:
+        uvicorn_queue = queue.SimpleQueue()
+        uvicorn_listener = QueueListener(uvicorn_queue, *uvicorn_logger.handlers, respect_handler_level=True)
+        uvicorn_listener.start()
+        atexit.register(uvicorn_listener.stop)
+        uvicorn_logger.handlers = [RecordQueueHandler(uvicorn_queue)]
+
 
 #### CODE TO DIFFERENTIATE PROD VS. LOCAL DATABASE SETTINGS
 # Get the DATABASE_URL from environment variables
@@ -27,104 +65,255 @@ if DATABASE_URL.startswith("postgres://"):
 
 
 
-# Database connection
-SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL")
-if not SQLALCHEMY_DATABASE_URL:
-    raise ValueError("DATABASE_URL environment variable is not set")
+# Database connection, through async drivers so queries run on the event loop instead of the threadpool
+if DATABASE_URL.startswith("postgresql://"):
+    DATABASE_URL = DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
+elif DATABASE_URL.startswith("sqlite://"):
+    DATABASE_URL = DATABASE_URL.replace("sqlite://", "sqlite+aiosqlite://", 1)
+
+# Connection pool settings, tunable per deployment
+if os.getenv("DATABASE_USE_PGBOUNCER") == "1":
+    # PgBouncer (transaction mode) does the pooling. Turn off both the asyncpg and the
+    # dialect statement caches, and give prepared statements unique names so they
+    # don't collide across the server connections PgBouncer hands out.
+    engine_options = {
+        "poolclass": NullPool,
+        "connect_args": {
+            "statement_cache_size": 0,
+            "prepared_statement_cache_size": 0,
+            "prepared_statement_name_func": lambda: f"__asyncpg_{uuid4()}__",
+        },
+    }
+else:
+    engine_options = {
+        "pool_size": int(os.getenv("DATABASE_POOL_SIZE", "20")),
+        "max_overflow": int(os.getenv("DATABASE_MAX_OVERFLOW", "10")),
+        "pool_timeout": int(os.getenv("DATABASE_POOL_TIMEOUT", "30")),
+        "pool_recycle": int(os.getenv("DATABASE_POOL_RECYCLE", "3600")),
+        "pool_pre_ping": True,
+    }
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-Base = declarative_base()
+# Compiled SQL cache (default 500); echo="debug" shows "[cached since ...]" on hits
+engine = create_async_engine(
+    DATABASE_URL,
+    query_cache_size=int(os.getenv("DATABASE_QUERY_CACHE_SIZE", "1200")),
+    **engine_options,
+)
+AsyncSessionLocal = async_sessionmaker(engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+class Base(DeclarativeBase):
+    pass
 
 # Define a simple model
 class Item(Base):
     __tablename__ = "items"
-    id = Column(Integer, primary_key=True, index=True)
-    name = Column(String, index=True)
+    id: Mapped[int] = mapped_column(primary_key=True)
+    name: Mapped[str] = mapped_column(String, index=True)
 
     def __repr__(self):
         return f"<Item(id={self.id}, name='{self.name}')>"
 
-# Create the database tables
-Base.metadata.create_all(bind=engine)
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# Arbitrary key for the Postgres advisory lock guarding table creation
+DDL_LOCK_KEY = 814_220_001
 
-app = FastAPI()
+# Create the database tables (set RUN_DDL=0 when migrations run before deploy)
+@app.on_event("startup")
+async def create_tables():
+    if os.getenv("RUN_DDL", "1") != "1":
+        return
+    async with engine.begin() as conn:
+        if conn.dialect.name == "postgresql":
+            # Workers wait here for the first one to commit its DDL, then find the tables already exist
+            await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": DDL_LOCK_KEY})
+        await conn.run_sync(Base.metadata.create_all)
+        # Tables created before Item.id lost index=True still carry this duplicate of the primary key index
+        await conn.execute(text("DROP INDEX IF EXISTS ix_items_id"))
  
-# enforce HTTPS - causing redirect loop on Railway
-# app.add_middleware(HTTPSRedirectMiddleware)
+# TLS is terminated at the proxy; uvicorn's proxy headers keep request.url.scheme accurate.
+# Redirecting here is only needed when nothing upstream enforces HTTPS.
+if os.getenv("ENABLE_HTTPS_REDIRECT") == "1":
+    app.add_middleware(HTTPSRedirectMiddleware)
 
 
 # Set up Jinja2 templates
 templates = Jinja2Templates(directory="templates")
+# Skip the per-render mtime check outside of development
+templates.env.auto_reload = DEBUG
+
+# Content hash per static file, appended as ?v= so changed assets get a new URL
+static_versions = {}
+
+# Root-relative static URLs, so rendered pages don't depend on the request's Host header
+def static_url(path):
+    version = static_versions.get(path)
+    if version is None or DEBUG:
+        with open(os.path.join("static", path.lstrip("/")), "rb") as f:
+            version = hashlib.blake2b(f.read(), digest_size=8).hexdigest()
+        static_versions[path] = version
+    return f"{app.url_path_for('static', path=path)}?v={version}"
+
+templates.env.globals["static_url"] = static_url
+
+# Compile templates once at startup so requests only render
+@app.on_event("startup")
+async def load_templates():
+    for name in ("index.html", "item_detail.html", "error.html"):
+        templates.env.get_template(name)
+
+# Fixed error messages, rendered to bytes once at startup
+ERROR_NOT_FOUND = "Item not found"
+ERROR_DATABASE = "Database error occurred"
+ERROR_UNEXPECTED = "An unexpected error occurred"
+error_pages = {}
+
+@app.on_event("startup")
+async def render_error_pages():
+    for message in (ERROR_NOT_FOUND, ERROR_DATABASE, ERROR_UNEXPECTED):
+        html = templates.get_template("error.html").render({"error": message})
+        error_pages[message] = html.encode()
+
+def error_response(message, status_code):
+    return Response(content=error_pages[message], media_type="text/html", status_code=status_code)
+
+# FastAPI's built-in handler always uses JSONResponse, so route validation errors through orjson here
+@app.exception_handler(RequestValidationError)
+async def validation_error_handler(request: Request, exc: RequestValidationError):
+    return ORJSONResponse(status_code=422, content={"detail": jsonable_encoder(exc.errors())})
+
+@app.exception_handler(SQLAlchemyError)
+async def database_error_handler(request: Request, exc: SQLAlchemyError):
+    logger.error("Database error in %s %s: %s", request.method, request.url.path, exc, exc_info=exc)
+    return error_response(ERROR_DATABASE, status_code=500)
+
+@app.exception_handler(Exception)
+async def unexpected_error_handler(request: Request, exc: Exception):
+    # ServerErrorMiddleware re-raises after this response, so the server logs the traceback
+    logger.error("Unexpected error in %s %s: %s", request.method, request.url.path, exc)
+    return error_response(ERROR_UNEXPECTED, status_code=500)
+
+# URLs from static_url() carry a content hash, so those can be cached for good;
+# plain /static/... URLs only get a short max-age
+STATIC_CACHE_CONTROL = os.getenv("STATIC_CACHE_CONTROL", "public, max-age=300")
+STATIC_CACHE_CONTROL_VERSIONED = "public, max-age=31536000, immutable"
+
+class CachedStaticFiles(StaticFiles):
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        versioned = scope.get("query_string", b"").startswith(b"v=")
+        response.headers["Cache-Control"] = STATIC_CACHE_CONTROL_VERSIONED if versioned else STATIC_CACHE_CONTROL
+        return response
 
 # Mount static files directory
-app.mount("/static", StaticFiles(directory="static"), name="static")
+app.mount("/static", CachedStaticFiles(directory="static", check_dir=False, html=False), name="static")
 
 # Dependency to get the database session
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
+
+# Rendered index pages keyed by (page, size), valid while index_version is unchanged.
+# The version lives in this process only, so enable it (INDEX_CACHE=1) only when running
+# exactly one process; with several workers, writes in one would leave the others stale.
+INDEX_CACHE_ENABLED = os.getenv("INDEX_CACHE") == "1"
+INDEX_CACHE_MAX_PAGES = 128
+index_version = 0
+index_cache = {}
+
+def invalidate_index_cache():
+    global index_version
+    index_version += 1
+    index_cache.clear()
 
 @app.get("/")
-async def root(request: Request, db: Session = Depends(get_db)):
-    try:
-        items = db.query(Item).all()
-        print(f"Items retrieved: {items}")  # Debug print
-        return templates.TemplateResponse("index.html", {"request": request, "items": items})
-    except Exception as e:
-        print(f"Error in root: {str(e)}")
-        return templates.TemplateResponse("error.html", {"request": request, "error": str(e)})
+async def root(
+    request: Request,
+    # Bounded so page * size stays a small OFFSET instead of overflowing the driver's integer type
+    page: int = Query(0, ge=0, le=100_000),
+    size: int = Query(50, ge=1, le=500),
+    db: AsyncSession = Depends(get_db),
+):
+    cached = index_cache.get((page, size))
+    if cached is not None and cached[0] == index_version:
+        return Response(content=cached[1], media_type="text/html")
+    # Writes during the query below bump the version and make this render stale
+    version = index_version
+    # Fetch one extra row to know whether there is a next page
+    stmt = select(Item).order_by(Item.id.desc()).limit(size + 1).offset(page * size)
+    items = (await db.execute(stmt)).scalars().all()
+    has_next = len(items) > size
+    items = items[:size]
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Items retrieved: %r", items)
+    response = templates.TemplateResponse("index.html", {
+        "request": request,
+        "items": items,
+        "size": size,
+        "prev_page": page - 1 if page > 0 else None,
+        "next_page": page + 1 if has_next else None,
+    })
+    if INDEX_CACHE_ENABLED and len(index_cache) < INDEX_CACHE_MAX_PAGES:
+        index_cache[(page, size)] = (version, response.body)
+    return response
 
 @app.post("/items/")
-async def create_item(request: Request, name: str = Form(...), db: Session = Depends(get_db)):
-    try:
-        new_item = Item(name=name)
-        db.add(new_item)
-        db.commit()
-        db.refresh(new_item)
-        print(f"New item created: {new_item}")  # Debug print
-        return RedirectResponse(url="/", status_code=303)
-    except Exception as e:
-        print(f"Error in create_item: {str(e)}")
-        return templates.TemplateResponse("error.html", {"request": request, "error": str(e)})
+async def create_item(request: Request, name: str = Form(...), db: AsyncSession = Depends(get_db)):
+    # RETURNING folds the id lookup into the INSERT, no refresh() needed
+    stmt = insert(Item).values(name=name).returning(Item.id)
+    new_id = (await db.execute(stmt)).scalar_one()
+    await db.commit()
+    invalidate_index_cache()
+    logger.debug("New item created: id=%s", new_id)
+    return RedirectResponse(url="/", status_code=303)
+
+def etag_matches(if_none_match, etag):
+    # If-None-Match may be "*" or a comma-separated list, and proxies may have weakened the tag to W/"..."
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
 
 @app.get("/items/{item_id}")
-async def read_item(request: Request, item_id: int, db: Session = Depends(get_db)):
-    try:
-        item = db.query(Item).filter(Item.id == item_id).first()
-        print(f"Retrieved item: {item}")  # Debug print
-        if item is None:
-            print(f"Item not found: id={item_id}")  # Debug print
-            return templates.TemplateResponse("error.html", {"request": request, "error": "Item not found"}, status_code=404)
-        print(f"Rendering item_detail.html for item: {item}")  # Debug print
-        return templates.TemplateResponse("item_detail.html", {"request": request, "item": item})
-    except SQLAlchemyError as e:
-        print(f"Database error in read_item: {str(e)}")
-        return templates.TemplateResponse("error.html", {"request": request, "error": "Database error occurred"}, status_code=500)
-    except Exception as e:
-        print(f"Unexpected error in read_item: {str(e)}")
-        return templates.TemplateResponse("error.html", {"request": request, "error": "An unexpected error occurred"}, status_code=500)
+async def read_item(request: Request, item_id: int, db: AsyncSession = Depends(get_db)):
+    item = await db.get(Item, item_id)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Retrieved item: %r", item)
+    if item is None:
+        logger.debug("Item not found: id=%s", item_id)
+        return error_response(ERROR_NOT_FOUND, status_code=404)
+    # Let clients revalidate with If-None-Match and skip the render on a match
+    etag = '"%s"' % hashlib.blake2b(f"{item.id}:{item.name}".encode(), digest_size=8).hexdigest()
+    cache_headers = {"ETag": etag, "Cache-Control": "private, max-age=60"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=cache_headers)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Rendering item_detail.html for item: %r", item)
+    return templates.TemplateResponse("item_detail.html", {"request": request, "item": item}, headers=cache_headers)
 
 @app.post("/items/{item_id}/delete")
-async def delete_item(request: Request, item_id: int, db: Session = Depends(get_db)):
-    try:
-        item = db.query(Item).filter(Item.id == item_id).first()
-        if item is None:
-            return templates.TemplateResponse("error.html", {"request": request, "error": "Item not found"}, status_code=404)
-        db.delete(item)
-        db.commit()
-        print(f"Item deleted: {item}")  # Debug print
-        return RedirectResponse(url="/", status_code=303)
-    except SQLAlchemyError as e:
-        print(f"Database error in delete_item: {str(e)}")
-        return templates.TemplateResponse("error.html", {"request": request, "error": "Database error occurred"}, status_code=500)
-    except Exception as e:
-        print(f"Unexpected error in delete_item: {str(e)}")
-        return templates.TemplateResponse("error.html", {"request": request, "error": "An unexpected error occurred"}, status_code=500)
+async def delete_item(request: Request, item_id: int, db: AsyncSession = Depends(get_db)):
+    result = await db.execute(delete(Item).where(Item.id == item_id))
+    await db.commit()
+    if result.rowcount == 0:
+        return error_response(ERROR_NOT_FOUND, status_code=404)
+    invalidate_index_cache()
+    logger.debug("Item deleted: id=%s", item_id)
+    return RedirectResponse(url="/", status_code=303)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+    # Each worker opens its own pool, so split the default 20 + 10 connections between them
+    os.environ.setdefault("DATABASE_POOL_SIZE", str(max(20 // workers, 2)))
+    os.environ.setdefault("DATABASE_MAX_OVERFLOW", str(max(10 // workers, 1)))
+    # Import string rather than the app object so uvicorn can spawn workers
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=workers,
+        proxy_headers=True,
+    )